@@ -1,4 +1,6 @@
+import os
 import warnings
+from collections import Counter, defaultdict
 from functools import partial
 
 import onnx
@@ -10,12 +12,18 @@ from tensorflow.python.ops.image_ops_impl import ResizeMethodV1
 
 
 class Operations:
+    def __init__(self):
+        self.op_methods = {name[3:]: getattr(self, name) for name in dir(self) if name.startswith('op_')}
+
     def make_op(self, op_type, inputs, attrs):
         # print(op_type)
         # print([i.shape for i in inputs])
         # print(attrs)
         # print()
-        return getattr(self, 'op_' + op_type.lower())(*inputs, **attrs)
+        op = self.op_methods.get(op_type.lower())
+        if op is None:
+            raise NotImplementedError("Unsupported onnx op: {}".format(op_type))
+        return op(*inputs, **attrs)
 
 class DataFormat: pass
 class OnnxTensor(DataFormat): pass
@@ -27,16 +35,35 @@ class OptimizationMissingWarning(Warning): pass
 def ensure_data_format(tensor, format):
     if issubclass(tensor.data_format, format):
         return tensor
-    elif tensor.data_format is OnnxConstant and format is InterleavedImageBatch:
+    # Each conversion is only done once per tensor, and converting back returns the original tensor,
+    # to avoid inserting duplicate transposes when a tensor has several consumers
+    conversions = getattr(tensor, 'data_format_conversions', None)
+    if conversions is None:
+        conversions = tensor.data_format_conversions = {}
+    for converted_format, converted in conversions.items():
+        if issubclass(converted_format, format):
+            return converted
+    out = convert_data_format(tensor, format)
+    conversions[format] = out
+    out.data_format_conversions = {tensor.data_format: tensor}
+    return out
+
+def convert_data_format(tensor, format):
+    # When height and width are 1, or there is a single channel, both formats have the same memory layout
+    if tensor.data_format is OnnxConstant and format is InterleavedImageBatch:
         assert len(tensor.shape) == 4
-        out = tensor.transpose([0, 2, 3, 1])
+        n, c, h, w = tensor.shape
+        if h == w == 1 or c == 1:
+            out = tensor.reshape(n, h, w, c)
+        else:
+            out = np.ascontiguousarray(tensor.transpose(0, 2, 3, 1)).view(Constant)
         out.data_format = InterleavedImageBatch
         return out
     elif tensor.data_format is OnnxTensor and format is InterleavedImageBatch:
         assert len(tensor.shape) == 4
         n, c, h, w = tensor.shape
-        if h == w == 1 or c == 1:
-            out = tf.reshape(tensor, [n, h, w, c])
+        if (h == w == 1 or c == 1) and (n, c, h, w).count(None) <= 1:
+            out = tf.reshape(tensor, [-1 if d is None else d for d in (n, h, w, c)])
         else:
             out = tf.transpose(tensor, [0, 2, 3, 1])
             warnings.warn("Transpose inserted. Please report at https://github.com/AxisCommunications/onnx-to-keras/issues", OptimizationMissingWarning)
@@ -45,8 +72,8 @@ def ensure_data_format(tensor, format):
     elif tensor.data_format is InterleavedImageBatch and format is OnnxTensor:
         assert len(tensor.shape) == 4
         n, h, w, c = tensor.shape
-        if h == w == 1 or c == 1:
-            out = tf.reshape(tensor, [n, c, h, w])
+        if (h == w == 1 or c == 1) and (n, c, h, w).count(None) <= 1:
+            out = tf.reshape(tensor, [-1 if d is None else d for d in (n, c, h, w)])
         else:
             out = tf.transpose(tensor, [0, 3, 1, 2])
             warnings.warn("Transpose inserted. Please report at https://github.com/AxisCommunications/onnx-to-keras/issues", OptimizationMissingWarning)
@@ -68,26 +95,177 @@ def ensure_compatible_data_format(a, b):
             return a, ensure_data_format(b, a.data_format)
     return ensure_data_format(a, b.data_format), b
 
+# Ops that need their first input in a specific data format. Layout agnostic ops work in either format and are
+# given the format preferred by their consumers when their inputs disagree.
+IMAGE_BATCH_OPS = {'conv', 'convtranspose', 'maxpool', 'averagepool', 'globalaveragepool', 'batchnormalization',
+                   'pad', 'slice', 'resize', 'upsample', 'reducemean'}
+ONNX_TENSOR_OPS = {'gemm', 'matmul', 'reshape', 'unsqueeze', 'gather'}
+LAYOUT_AGNOSTIC_OPS = {'relu', 'leakyrelu', 'sigmoid', 'clip', 'sqrt', 'abs', 'neg', 'add', 'sub', 'mul', 'equal',
+                       'and', 'greater', 'concat', 'softmax'}
+
+def produced_formats(graph):
+    # The format each tensor is expected to be produced in, following the same op classes as layout_plan
+    initializers = {init.name for init in graph.initializer}
+    produced = {i.name: InterleavedImageBatch for i in graph.input if i.name not in initializers}
+    for node in graph.node:
+        op_type = node.op_type.lower()
+        if op_type in IMAGE_BATCH_OPS:
+            format = InterleavedImageBatch
+        elif op_type in ONNX_TENSOR_OPS:
+            format = OnnxTensor
+        elif op_type in LAYOUT_AGNOSTIC_OPS:
+            format = next((produced[i] for i in node.input if i in produced), None)
+        else:
+            format = None
+        if format is not None:
+            produced.update((o, format) for o in node.output)
+    return produced
+
+def preferred_format(votes, produced):
+    # Ties are broken in favour of the format the tensor already has, so no transpose is inserted without a reason,
+    # and otherwise in favour of the keras image layout
+    counts = votes.most_common()
+    best = [format for format, n in counts if n == counts[0][1]]
+    if produced in best:
+        return produced
+    return InterleavedImageBatch if InterleavedImageBatch in best else best[0]
+
+def layout_plan(graph):
+    produced = produced_formats(graph)
+    votes = defaultdict(Counter)
+    # Nodes are topologically sorted, so a single backward pass propagates the preferences of the consumers
+    # through chains of layout agnostic ops
+    for node in reversed(graph.node):
+        op_type = node.op_type.lower()
+        if op_type in IMAGE_BATCH_OPS:
+            votes[node.input[0]][InterleavedImageBatch] += 1
+        elif op_type in ONNX_TENSOR_OPS:
+            votes[node.input[0]][OnnxTensor] += 1
+        elif op_type in LAYOUT_AGNOSTIC_OPS and votes[node.output[0]]:
+            format = preferred_format(votes[node.output[0]], produced.get(node.output[0]))
+            for i in node.input:
+                votes[i][format] += 1
+    return {name: preferred_format(v, produced.get(name)) for name, v in votes.items() if v}
+
+def ensure_planned_data_format(tensors, format):
+    # A transpose is only unavoidable if the inputs disagree, and then it is placed where it is not needed again
+    formats = {t.data_format for t in tensors if t.data_format is not OnnxConstant and len(t.shape) == 4}
+    if format is None or len(formats) < 2:
+        return tensors
+    return [t if t.data_format is OnnxConstant or len(t.shape) != 4 else ensure_data_format(t, format)
+            for t in tensors]
+
 class Constant(np.ndarray):
     data_format = OnnxConstant
 
+def is_foldable(*tensors):
+    # Ops on constants are evaluated with numpy when the model is built instead of becoming part of it
+    return all(isinstance(t, Constant) and t.data_format is OnnxConstant for t in tensors)
+
+CAST_DTYPES = {
+    0: None, # UNDEFINED
+    1: np.float32,
+    2: np.uint8,
+    3: np.int8,
+    4: np.uint16,
+    5: np.int16,
+    6: np.int32,
+    7: np.int64,
+    8: np.str_,
+    9: np.bool_,
+    10: np.float16,
+    11: np.float64,
+    12: np.uint32,
+    13: np.uint64,
+    14: np.complex64,
+    15: np.complex128,
+    # // Non-IEEE floating-point format based on IEEE754 single-precision
+    # // floating-point number truncated to 16 bits.
+    # // This format has 1 sign bit, 8 exponent bits, and 7 mantissa bits.
+    #BFLOAT16 = 16;
+}
+
+def remap_axis(x, axis):
+    # The axis of x that corresponds to the given axis of the onnx tensor
+    axis %= len(x.shape)
+    if x.data_format is InterleavedImageBatch and len(x.shape) == 4:
+        return (0, 3, 1, 2)[axis]
+    return axis
+
+def concatenated_slices(tensors, axis):
+    # If the tensors are consecutive slices, covering all of the tensor they were sliced from, that tensor is returned
+    slices = [getattr(t, 'slice_of', None) for t in tensors]
+    if any(s is None for s in slices):
+        return None
+    source = slices[0][0]
+    end = 0
+    for sliced, sliced_axis, start, stop in slices:
+        if sliced is not source or sliced_axis != axis % 4 or start != end:
+            return None
+        end = stop
+    if end != source.shape[remap_axis(source, axis)]:
+        return None
+    return source
+
+def kernel_transpose(weights, axes):
+    # The onnx kernel reordered into keras layout as a single contiguous copy
+    return np.ascontiguousarray(weights.transpose(axes)).view(Constant)
+
+def split_channels(x, groups):
+    # Splits the last axis into groups that each are contiguous, using a single copy
+    return np.ascontiguousarray(np.moveaxis(x.reshape(x.shape[:-1] + (groups, -1)), -2, 0))
+
+def block_diagonal_kernel(weights, groups):
+    # Keras kernel (kH, kW, in_channels / groups, out_channels) -> (kH, kW, in_channels, out_channels)
+    h, w, group_in, out = weights.shape
+    group_out = out // groups
+    kernel = np.zeros((h, w, group_in * groups, out), weights.dtype)
+    for i in range(groups):
+        kernel[:, :, i*group_in:(i+1)*group_in, i*group_out:(i+1)*group_out] = weights[:, :, :, i*group_out:(i+1)*group_out]
+    return kernel.view(Constant)
+
+ATTR_PARSERS = {
+    onnx.AttributeProto.INT: lambda ops, a: a.i,
+    onnx.AttributeProto.INTS: lambda ops, a: tuple(a.ints),
+    onnx.AttributeProto.FLOAT: lambda ops, a: a.f,
+    onnx.AttributeProto.STRING: lambda ops, a: a.s,
+    onnx.AttributeProto.TENSOR: lambda ops, a: ops.make_constant(numpy_helper.to_array(a.t)),
+}
+
+def conv_padding(kernel_shape, pads, strides, dilations, odd_input):
+    # Keras padding mode equivalent to the onnx pads of a conv, or None if explicit padding is needed
+    if pads == (0,0,0,0):
+        return 'valid'
+    elif (kernel_shape[0] == kernel_shape[1] and pads[0] == pads[1] == pads[2] == pads[3] and
+          pads[0] * 2 + 1 == kernel_shape[0] and strides == (1, 1) and dilations == (1, 1)):
+        return 'same'
+    elif kernel_shape == (3, 3) and pads == (1,1,1,1) and strides == (2,2) and dilations == (1, 1) and odd_input:
+        return 'same'
+    return None
+
 class TfKerasOperations(Operations):
     keras = tf.keras
     make_tflite_compatible = False
+    opset = 13
+    max_block_diagonal_groups = 4
+
+    def __init__(self):
+        super().__init__()
+        self.padding_layers = {}
+
+    def zero_padding(self, pads):
+        # ((top_pad, bottom_pad), (left_pad, right_pad))
+        padding = ((pads[0], pads[2]), (pads[1], pads[3]))
+        # The layer has no weights, so convs with the same padding can share it
+        if padding not in self.padding_layers:
+            self.padding_layers[padding] = self.keras.layers.ZeroPadding2D(padding)
+        return self.padding_layers[padding]
 
     def parse_attr(self, a):
-        if a.type == onnx.AttributeProto.INT:
-            return a.i
-        elif a.type == onnx.AttributeProto.INTS:
-            return tuple(a.ints)
-        elif a.type == onnx.AttributeProto.FLOAT:
-            return a.f
-        elif a.type == onnx.AttributeProto.STRING:
-            return a.s
-        elif a.type == onnx.AttributeProto.TENSOR:
-            return self.make_constant(numpy_helper.to_array(a.t))
-        else:
+        parser = ATTR_PARSERS.get(a.type)
+        if parser is None:
             raise NotImplementedError
+        return parser(self, a)
 
     def make_constant(self, x):
         return np.asarray(x).view(Constant)
@@ -113,18 +291,24 @@ class TfKerasOperations(Operations):
         }
 
         if group > 1 and group == x.shape[3]: # Dephwise conv
-            weights = weights.transpose(2, 3, 0, 1)
+            weights = kernel_transpose(weights, (2, 3, 0, 1))
             ConvClass = self.keras.layers.DepthwiseConv2D
         elif not self.make_tflite_compatible or group == 1: # Regular conv
-            weights = weights.transpose(2, 3, 1, 0)
+            weights = kernel_transpose(weights, (2, 3, 1, 0))
             conv_args['filters'] = weights.shape[3]
             ConvClass = self.keras.layers.Conv2D
             conv_args['groups'] = group
+        # Grouped convolutions is supported in tf/keras but not yet supported in tflite
+        # https://github.com/tensorflow/tensorflow/issues/40044
+        elif group <= self.max_block_diagonal_groups: # Grouped conv as a single regular conv
+            # The kernel is zero between groups, which costs group times more weights and multiplications
+            # but is still faster than splitting the input into a few convs
+            weights = block_diagonal_kernel(kernel_transpose(weights, (2, 3, 1, 0)), group)
+            conv_args['filters'] = weights.shape[3]
+            ConvClass = self.keras.layers.Conv2D
         else: # Grouped conv
-            # Grouped convolutions is supported in tf/keras but not yet supported in tflite
-            # https://github.com/tensorflow/tensorflow/issues/40044
             warnings.warn(
-                "Grouped conv splitted into {} regular convs for tflite compatibility.",
+                "Grouped conv splitted into {} regular convs for tflite compatibility.".format(group),
                 OptimizationMissingWarning
             )
             class GroupedConv:
@@ -132,7 +316,6 @@ class TfKerasOperations(Operations):
                     self.groups, kwargs['groups'] = kwargs['groups'], 1
                     self.use_bias = kwargs['use_bias']
                     kwargs['filters'] //= self.groups
-                    self.filters = kwargs['filters']
 
                     self.conv_layers = []
                     for _ in range(self.groups):
@@ -147,47 +330,56 @@ class TfKerasOperations(Operations):
                     return tf.concat(convolved_splits, -1)
 
                 def set_weights(self, w):
-                    n = self.filters
+                    grouped_w = split_channels(w[0], self.groups)
+                    if self.use_bias:
+                        grouped_b = split_channels(w[1], self.groups)
                     for i, layer in enumerate(self.conv_layers):
-                        grouped_w = w[0][:, :, :, i*n:(i+1)*n]
                         if self.use_bias:
-                            grouped_b = w[1][i*n:(i+1)*n]
-                            layer.set_weights([grouped_w.view(np.ndarray), grouped_b.view(np.ndarray)])
+                            layer.set_weights([grouped_w[i], grouped_b[i]])
                         else:
-                            layer.set_weights([grouped_w.view(np.ndarray)])
+                            layer.set_weights([grouped_w[i]])
 
-            weights = weights.transpose(2, 3, 1, 0)
+            weights = kernel_transpose(weights, (2, 3, 1, 0))
             conv_args['filters'] = weights.shape[3]
             conv_args['groups'] = group
             ConvClass = GroupedConv
 
         conv_args['use_bias'] = not bias is None
 
-        if pads == (0,0,0,0):
-            conv_args['padding'] = 'valid'
-        elif (kernel_shape[0] == kernel_shape[1] and pads[0] == pads[1] == pads[2] == pads[3] and
-              pads[0] * 2 + 1 == kernel_shape[0] and strides == (1, 1) and dilations == (1, 1)):
-            conv_args['padding'] = 'same'
-        elif (kernel_shape == (3, 3) and pads == (1,1,1,1) and strides == (2,2) and dilations == (1, 1) and
-              not (x.shape[1] == None or x.shape[2] == None) and x.shape[1] % 2 == 1 and x.shape[2] % 2 == 1):
-            conv_args['padding'] = 'same'
-        else:
-            # ((top_pad, bottom_pad), (left_pad, right_pad))
-            pad = self.keras.layers.ZeroPadding2D(((pads[0], pads[2]), (pads[1], pads[3])))
-            x = pad(x)
-            conv_args['padding'] = 'valid'
+        odd_input = not (x.shape[1] is None or x.shape[2] is None) and x.shape[1] % 2 == 1 and x.shape[2] % 2 == 1
+        padding = conv_padding(kernel_shape, pads, strides, dilations, odd_input)
+        if padding is None:
+            x = self.zero_padding(pads)(x)
+            padding = 'valid'
+        conv_args['padding'] = padding
 
         conv = ConvClass(**conv_args)
         out = conv(x)
         out.data_format = InterleavedImageBatch
 
-        if conv_args['use_bias']:
-            conv.set_weights([weights.view(np.ndarray), bias.view(np.ndarray)])
+        if isinstance(conv, self.keras.layers.Layer):
+            # Allows a following BatchNormalization to be folded into the conv. The weights are held back until
+            # it is known whether that happens, see set_conv_weights
+            out.foldable_conv = (conv, x, weights, bias)
+        elif conv_args['use_bias']:
+            conv.set_weights([weights, np.ascontiguousarray(bias)])
         else:
-            conv.set_weights([weights.view(np.ndarray)])
+            conv.set_weights([weights])
 
         return [out]
 
+    def set_conv_weights(self, tensor):
+        # Sets the held back weights of the conv producing tensor, once no BatchNormalization will be folded into it,
+        # and drops the reference to them so they are not kept alive by the model
+        foldable_conv = getattr(tensor, 'foldable_conv', None)
+        if foldable_conv is not None:
+            conv, x, weights, bias = foldable_conv
+            if bias is None:
+                conv.set_weights([weights])
+            else:
+                conv.set_weights([weights, np.ascontiguousarray(bias)])
+            tensor.foldable_conv = None
+
     def op_relu(self, x):
         out = self.keras.layers.ReLU()(x)
         out.data_format = x.data_format
@@ -203,21 +395,32 @@ class TfKerasOperations(Operations):
         out.data_format = x.data_format
         return [out]
 
-    def op_softmax(self, x, axis):
-        out = self.keras.activations.softmax(x, axis=axis)
+    def op_softmax(self, x, axis=None):
+        if axis is None:
+            axis = -1 if self.opset >= 13 else 1
+        rank = len(x.shape)
+        axis %= rank
+        if self.opset < 13 and any(x.shape[remap_axis(x, ax)] != 1 for ax in range(axis + 1, rank)):
+            # Before opset 13 the softmax is taken over all axes from axis on, flattened together
+            raise NotImplementedError
+        out = self.keras.activations.softmax(x, axis=remap_axis(x, axis))
         out.data_format = x.data_format
         return [out]
 
     def op_prelu(self, x, alpha):
         alpha = ensure_data_format(alpha, OnnxConstant)  # XXX Assumes no ops on alpha
-        if len(alpha) == 1:
-            shared = list(range(1, len(x.shape)))
-            alpha = alpha.reshape((1,) * (len(x.shape) - 1))
-        elif len(alpha) == x.shape[-1]:
-            shared = list(range(1, len(x.shape) - 1))
+        rank = len(x.shape)
+        channel_axis = remap_axis(x, 1)
+        if alpha.size == 1:
+            shared = list(range(1, rank))
+        elif rank > 2 and alpha.shape == (x.shape[channel_axis],) + (1,) * (rank - 2):  # Per channel alpha
+            shared = [ax for ax in range(1, rank) if ax != channel_axis]
+        elif alpha.shape == (x.shape[-1],) and x.data_format is not InterleavedImageBatch:
+            shared = list(range(1, rank - 1))
         else:
             raise NotImplementedError
-        alpha_initializer = self.keras.initializers.Constant(alpha.view(np.ndarray))
+        alpha = alpha.reshape([1 if ax in shared else x.shape[ax] for ax in range(1, rank)])
+        alpha_initializer = self.keras.initializers.Constant(np.ascontiguousarray(alpha))
         out = self.keras.layers.PReLU(shared_axes=shared, alpha_initializer=alpha_initializer)(x)
         out.data_format = x.data_format
         return [out]
@@ -229,9 +432,7 @@ class TfKerasOperations(Operations):
             if pads == (0, 0, 0, 0):
                 padding = 'valid'
             else:
-                # ((top_pad, bottom_pad), (left_pad, right_pad))
-                pad = self.keras.layers.ZeroPadding2D(((pads[0], pads[2]), (pads[1], pads[3])))
-                x = pad(x)
+                x = self.zero_padding(pads)(x)
                 padding = 'valid'
             out = self.keras.layers.MaxPool2D(kernel_shape, strides, padding)(x)
             out.data_format = InterleavedImageBatch
@@ -240,9 +441,13 @@ class TfKerasOperations(Operations):
             raise NotImplementedError
 
     def op_concat(self, *tensors, axis):
+        if len(tensors) == 1:
+            return [tensors[0]]
         if all(t.data_format is InterleavedImageBatch for t in tensors):
-            axis = (0, 3, 1, 2)[axis]
-            out = self.keras.layers.Concatenate(axis)(list(tensors))
+            source = concatenated_slices(tensors, axis)
+            if source is not None:
+                return [source]
+            out = tf.concat(list(tensors), remap_axis(tensors[0], axis))
             out.data_format = InterleavedImageBatch
         elif all(t.data_format is OnnxConstant for t in tensors):
             out = self.make_constant(np.concatenate(tensors, axis))
@@ -285,7 +490,7 @@ class TfKerasOperations(Operations):
                 raise NotImplementedError
             # Tf; filter_height, filter_width, out_channels, in_channels
             # Torch: (in_channels, out_channels, kH, kW)
-            weights = weights.transpose(2, 3, 1, 0)
+            weights = kernel_transpose(weights, (2, 3, 1, 0))
             filters = weights.shape[2]
             if group == 1:
                 conv = self.keras.layers.Conv2DTranspose(filters, kernel_shape, strides,
@@ -295,14 +500,16 @@ class TfKerasOperations(Operations):
                                                          output_padding=output_padding)
                 out = conv(x)
                 if use_bias:
-                    conv.set_weights([weights.view(np.ndarray), bias.view(np.ndarray)])
+                    conv.set_weights([weights, np.ascontiguousarray(bias)])
                 else:
-                    conv.set_weights([weights.view(np.ndarray)])
+                    conv.set_weights([weights])
             else:
                 splits = tf.split(x, group, axis=-1)
                 convolved_splits = []
-                n = weights.shape[3] // group
-                assert group * n == weights.shape[3]
+                assert weights.shape[3] % group == 0
+                grouped_weights = split_channels(weights, group)
+                if use_bias:
+                    grouped_bias = split_channels(bias, group)
                 for i, split in enumerate(splits):
                     conv = self.keras.layers.Conv2DTranspose(filters, kernel_shape, strides,
                                                              dilation_rate=dilations, padding=padding,
@@ -310,12 +517,10 @@ class TfKerasOperations(Operations):
                                                              use_bias=use_bias, bias_initializer='zeros',
                                                              output_padding=output_padding)
                     convolved_splits.append(conv(split))
-                    grouped_weights = weights[:, :, :, i*n:(i+1)*n]
                     if use_bias:
-                        grouped_bias = bias[i*n:(i+1)*n]
-                        conv.set_weights([grouped_weights.view(np.ndarray), grouped_bias.view(np.ndarray)])
+                        conv.set_weights([grouped_weights[i], grouped_bias[i]])
                     else:
-                        conv.set_weights([grouped_weights.view(np.ndarray)])
+                        conv.set_weights([grouped_weights[i]])
                 out = tf.concat(convolved_splits, -1)
 
             assert out.shape[1] == h_out
@@ -326,22 +531,53 @@ class TfKerasOperations(Operations):
             raise NotImplementedError
 
     def op_batchnormalization(self, x, weight, bias, running_mean, running_var, momentum, epsilon):
+        if getattr(x, 'foldable_conv', None) is not None and is_foldable(weight, bias, running_mean, running_var):
+            return [self.fold_batchnormalization(x, weight, bias, running_mean, running_var, epsilon)]
         norm = self.keras.layers.BatchNormalization(momentum=momentum, epsilon=epsilon)
         out = norm(x)
-        norm.set_weights([weight.view(np.ndarray), bias.view(np.ndarray),
-                          running_mean.view(np.ndarray), running_var.view(np.ndarray)])
+        norm.set_weights([np.ascontiguousarray(weight), np.ascontiguousarray(bias),
+                          np.ascontiguousarray(running_mean), np.ascontiguousarray(running_var)])
         out.data_format = x.data_format
         return [out]
 
+    def fold_batchnormalization(self, conv_out, weight, bias, running_mean, running_var, epsilon):
+        # The folded weights are given to the conv instead of the held back ones. A conv without bias is recreated,
+        # with a bias, from the same input
+        conv, x, weights, conv_bias = conv_out.foldable_conv
+        conv_out.foldable_conv = None
+        scale = weight / np.sqrt(running_var + epsilon)
+        if isinstance(conv, self.keras.layers.DepthwiseConv2D):
+            weights = weights * scale.reshape(weights.shape[2:])
+        else:
+            weights = weights * scale
+        if conv_bias is None:
+            config = conv.get_config()
+            del config['name']
+            config['use_bias'] = True
+            conv = conv.__class__.from_config(config)
+            conv_out = conv(x)
+            conv_out.data_format = InterleavedImageBatch
+            conv_bias = np.zeros_like(running_mean)
+        bias = (conv_bias - running_mean) * scale + bias
+        conv.set_weights([np.ascontiguousarray(weights), np.ascontiguousarray(bias)])
+        return conv_out
+
     def op_unsqueeze(self, x, axes):
         x = ensure_data_format(x, OnnxTensor)
-        out = x
+        rank = len(x.shape) + len(axes)
+        axes = sorted(ax % rank for ax in axes)
+        shape = list(x.shape)
+        for ax in axes:
+            shape.insert(ax, 1)
         if isinstance(x, Constant):
-            for ax in sorted(axes):
-                out = np.expand_dims(out, ax).view(Constant)
+            out = x.reshape(shape).view(Constant)
             out.data_format = x.data_format
+        elif shape.count(None) <= 1:
+            out = tf.reshape(x, [-1 if d is None else d for d in shape])
+            out.data_format = OnnxTensor
         else:
-            for ax in sorted(axes):
+            out = x
+            for ax in axes:
                 out = self.keras.backend.expand_dims(out, ax)
             out.data_format = OnnxTensor
         return [out]
@@ -355,12 +591,16 @@ class TfKerasOperations(Operations):
         return [out]
 
     def op_add(self, x1, x2):
+        if is_foldable(x1, x2):
+            return [self.make_constant(np.add(x1, x2))]
         x1, x2 = ensure_compatible_data_format(x1, x2)
         out = self.keras.layers.Add()([x1, x2])
         out.data_format = x1.data_format
         return [out]
 
     def op_sub(self, x1, x2):
+        if is_foldable(x1, x2):
+            return [self.make_constant(np.subtract(x1, x2))]
         x1, x2 = ensure_compatible_data_format(x1, x2)
         out = self.keras.layers.Subtract()([x1, x2])
         out.data_format = x1.data_format
@@ -371,6 +611,9 @@ class TfKerasOperations(Operations):
         if axes == (2, 3) and keepdims == 0:
             out = self.keras.layers.GlobalAveragePooling2D()(x)
             out.data_format = OnnxTensor
+        elif axes == (2, 3) and keepdims == 1:
+            out = self.keras.layers.GlobalAveragePooling2D(keepdims=True)(x)
+            out.data_format = InterleavedImageBatch
         else:
             raise NotImplementedError
 
@@ -381,7 +624,7 @@ class TfKerasOperations(Operations):
         if beta == 1.0 and transB == 1 and alpha == 1.0:
             out = self.keras.layers.Dense(weights.shape[0], kernel_initializer='zeros',
                                           bias_initializer='zeros',
-                                          weights=[weights.view(np.ndarray).T, bias.view(np.ndarray)])(x)
+                                          weights=[np.ascontiguousarray(weights.T), np.ascontiguousarray(bias)])(x)
             out.data_format = OnnxTensor
         else:
             raise NotImplementedError
@@ -423,7 +666,7 @@ class TfKerasOperations(Operations):
     def op_globalaveragepool(self, x):
         x = ensure_data_format(x, InterleavedImageBatch)
         if len(x.shape) == 4:
-            out = self.keras.backend.mean(x, axis=[1, 2], keepdims=True)
+            out = self.keras.layers.GlobalAveragePooling2D(keepdims=True)(x)
         else:
             raise NotImplementedError
         out.data_format = InterleavedImageBatch
@@ -431,7 +674,7 @@ class TfKerasOperations(Operations):
 
     def op_flatten(self, x, axis):
         if axis == 1 and len(x.shape) == 4 and x.shape[1] == 1 and x.shape[2] == 1:
-            out = self.keras.layers.Flatten()(x)
+            out = tf.reshape(x, [-1, int(np.prod(x.shape[1:]))])
         else:
             raise NotImplementedError
         out.data_format = OnnxTensor
@@ -442,7 +685,7 @@ class TfKerasOperations(Operations):
             axes = range(len(starts))
         if steps is None:
             steps = [1] * len(starts)
-        if x.data_format is OnnxConstant:
+        if is_foldable(x):
             if axes != (0,):
                 raise NotImplementedError
             out = self.make_constant(x[starts[0]:ends[0]:steps[0]])
@@ -461,6 +704,9 @@ class TfKerasOperations(Operations):
                     out = x[:,:,starts[0]:ends[0]:steps[0],:]
                 else:
                     raise NotImplementedError
+                dim = x.shape[remap_axis(x, axes[0])]
+                if dim is not None and steps[0] == 1:
+                    out.slice_of = (x, axes[0]) + slice(starts[0], ends[0]).indices(dim)[:2]
             elif tuple(axes) == (2,3) and starts[0] != ends[0] and starts[1] != ends[1]:
                 out = x[:,starts[0]:ends[0]:steps[0],starts[1]:ends[1]:steps[1],:]
             else:
@@ -481,7 +727,7 @@ class TfKerasOperations(Operations):
         return [self.make_constant(shape)]
 
     def op_gather(self, x, indices, axis=0):
-        if x.data_format is OnnxConstant and axis == 0:
+        if is_foldable(x) and axis == 0:
             return [self.make_constant(x[indices])]
         elif x.data_format is OnnxTensor:
             x = tf.gather(x, self.make_constant(indices), axis=axis)
@@ -491,36 +737,17 @@ class TfKerasOperations(Operations):
             raise NotImplementedError
 
     def op_cast(self, x, to):
-        dtype = {
-            0: None, # UNDEFINED
-            1: np.float,
-            2: np.uint8,
-            3: np.int8,
-            4: np.uint16,
-            5: np.int16,
-            6: np.int32,
-            7: np.int64,
-            8: str,
-            9: np.bool,
-            10: np.float16,
-            11: np.double,
-            12: np.uint32,
-            13: np.uint64,
-            14: np.complex64,
-            15: np.complex128,
-            # // Non-IEEE floating-point format based on IEEE754 single-precision
-            # // floating-point number truncated to 16 bits.
-            # // This format has 1 sign bit, 8 exponent bits, and 7 mantissa bits.
-            #BFLOAT16 = 16;
-        }[to]
-        if x.data_format is OnnxConstant:
+        dtype = CAST_DTYPES[to]
+        if is_foldable(x):
             return [self.make_constant(x.astype(dtype))]
         else:
-            out = self.keras.backend.cast(x, dtype)
+            out = self.keras.backend.cast(x, tf.as_dtype(dtype))
             out.data_format = x.data_format
             return [out]
 
     def op_mul(self, a, b):
+        if is_foldable(a, b):
+            return [self.make_constant(np.multiply(a, b))]
         if b.shape == ():
             a, b = b, a
         if a.shape == ():
@@ -528,12 +755,9 @@ class TfKerasOperations(Operations):
             out.data_format = b.data_format
             return [out]
         a, b = ensure_compatible_data_format(a, b)
-        if a.data_format is OnnxConstant:
-            return [self.make_constant(a * b)]
-        else:
-            out = tf.keras.layers.Multiply()([a, b])
-            out.data_format = a.data_format
-            return [out]
+        out = tf.keras.layers.Multiply()([a, b])
+        out.data_format = a.data_format
+        return [out]
 
     def op_floor(self, x):
         x = ensure_data_format(x, OnnxConstant)
@@ -598,19 +822,24 @@ class TfKerasOperations(Operations):
     def op_reshape(self, x, shape):
         x = ensure_data_format(x, OnnxTensor)
         assert x.shape[0] == shape[0]
-        out = self.keras.layers.Reshape(shape[1:])(x)
+        out = tf.reshape(x, [int(d) for d in shape])
         out.data_format = OnnxTensor
         return [out]
 
     def op_transpose(self, x, perm):
-        if x.data_format is InterleavedImageBatch and tuple(perm) == (0, 2, 3, 1):
+        perm = tuple(perm)
+        if x.data_format is InterleavedImageBatch and perm == (0, 2, 3, 1):
+            # The data is already in the requested order, but a separate tensor is needed to carry the other
+            # data_format. It has to be a keras tensor, as keras can only build models from tensors it created.
             x = tf.identity(x)
             x.data_format = OnnxTensor
             return [x]
-        x = ensure_data_format(x, OnnxConstant)
-        x = tf.transpose(x, perm)
-        x.data_format = OnnxConstant
-        return [x]
+        x = ensure_data_format(x, OnnxTensor)
+        if is_foldable(x):
+            return [self.make_constant(np.transpose(x, perm))]
+        out = tf.transpose(x, perm)
+        out.data_format = OnnxTensor
+        return [out]
 
     def op_matmul(self, x1, x2):
         x1 = ensure_data_format(x1, OnnxTensor)
@@ -619,20 +848,10 @@ class TfKerasOperations(Operations):
             x1 = tf.convert_to_tensor(x1)
         if x2.data_format is OnnxConstant:
             x2 = tf.convert_to_tensor(x2)
-        if len(x1.shape) == 2:
-            assert len(x2.shape) == 2
-            out = self.keras.backend.dot(x1, x2)
-        elif len(x1.shape) == 3:
-            assert len(x2.shape) == 3
-            assert x1.shape[0] == x2.shape[0] == 1
-            out = self.keras.backend.dot(x1, x2)
-            out = tf.reshape(out, (1, out.shape[1], out.shape[3]))
-        elif len(x1.shape) == 4:
-            assert len(x2.shape) == 4
-            assert x1.shape[0] == x2.shape[0] == 1
-            assert x1.shape[1] == x2.shape[1] == 1
-            out = self.keras.backend.dot(x1, x2)
-            out = tf.reshape(out, (1, 1, out.shape[2], out.shape[5]))
+        # keras.backend.dot forms the outer product over the batch dimensions, tf.matmul is a batched matmul
+        if len(x1.shape) in (2, 3, 4):
+            assert len(x2.shape) == len(x1.shape)
+            out = tf.matmul(x1, x2)
         else:
             raise NotImplementedError
         out.data_format = OnnxTensor
@@ -655,13 +874,21 @@ class TfKerasOperations(Operations):
 
 
 
-def onnx2keras(onnx_model, make_tflite_compatible=False):
-    tensors = {}
+def load_initializer(init, base_dir=''):
+    # Weights stored in an external file are memory mapped instead of read into memory, if the model
+    # was loaded with load_external_data=False
+    if init.data_location == onnx.TensorProto.EXTERNAL and not init.HasField('raw_data') and all(init.dims):
+        info = {entry.key: entry.value for entry in init.external_data}
+        return np.memmap(os.path.join(base_dir, info['location']), TENSOR_TYPE_TO_NP_TYPE[init.data_type], 'r',
+                         int(info.get('offset', 0)), tuple(init.dims))
+    return numpy_helper.to_array(init, base_dir)
+
+def onnx2keras(onnx_model, make_tflite_compatible=False, base_dir=''):
     ops = TfKerasOperations()
     ops.make_tflite_compatible = make_tflite_compatible
+    ops.opset = next((o.version for o in onnx_model.opset_import if o.domain in ('', 'ai.onnx')), ops.opset)
 
-    for init in onnx_model.graph.initializer:
-        tensors[init.name] = ops.make_constant(numpy_helper.to_array(init))
+    tensors = {init.name: ops.make_constant(load_initializer(init, base_dir)) for init in onnx_model.graph.initializer}
 
     model_inputs = []
     for input in onnx_model.graph.input:
@@ -673,13 +900,25 @@ def onnx2keras(onnx_model, make_tflite_compatible=False):
         tensors[input.name] = ops.make_input(shape, dtype)
         model_inputs.append(tensors[input.name])
 
+    plan = layout_plan(onnx_model.graph)
+    consumers = Counter(i for node in onnx_model.graph.node for i in node.input)
+    graph_outputs = {o.name for o in onnx_model.graph.output}
+    make_op, parse_attr = ops.make_op, ops.parse_attr
     for node in onnx_model.graph.node:
+        op_type = node.op_type.lower()
         inputs = [tensors[i] for i in node.input]
-        attrs = {a.name: ops.parse_attr(a) for a in node.attribute}
-        output_tensors = ops.make_op(node.op_type, inputs, attrs)
+        if op_type in LAYOUT_AGNOSTIC_OPS:
+            inputs = ensure_planned_data_format(inputs, plan.get(node.output[0]))
+        attrs = {a.name: parse_attr(a) for a in node.attribute}
+        output_tensors = make_op(op_type, inputs, attrs)
         assert len(output_tensors) == len(node.output)
+        for i in node.input:
+            ops.set_conv_weights(tensors[i])
         for n, t in zip(node.output, output_tensors):
-            tensors[n] = t
+            if consumers[n] != 1 or n in graph_outputs:
+                # Folding a BatchNormalization into the conv would compute the conv twice
+                ops.set_conv_weights(t)
+        tensors.update(zip(node.output, output_tensors))
 
     outputs = [tensors[o.name] for o in onnx_model.graph.output]
     return tf.keras.models.Model(model_inputs, outputs)
@@ -715,12 +954,15 @@ def verify(keras_model, onnx_model_file, decimals=2):
         onnx_indata[onnx_input.name] = indata.transpose(0, 3, 1, 2)
 
     onnx_outdata = onnx_sess.run(None, onnx_indata)
-    keras_outdata = keras_model.predict(keras_indata)
+    # Run as a single XLA compiled graph, the way the model is typically deployed, instead of through predict
+    infer = tf.function(lambda x: keras_model(x, training=False), jit_compile=True)
+    keras_outdata = infer(keras_indata if len(keras_indata) > 1 else keras_indata[0])
 
     if not isinstance(keras_outdata, list):
         keras_outdata = [keras_outdata]
 
     for onnx_out, keras_out in zip(onnx_outdata, keras_outdata):
+        keras_out = keras_out.numpy()
         if len(keras_out.shape) == 4:
             warnings.warn("Found 4D output, assuming output is an image, transposing output when verifying model.")
             keras_out = keras_out.transpose(0, 3, 1, 2)
@@ -735,7 +977,7 @@ def main(infile, outfile=None, export_saved_model=False, verify_model=True, make
     if outfile is None:
         outfile = infile[:-5] if infile[-5:] == '.onnx' else infile
         outfile += '.h5'
-    model = onnx2keras(onnx.load(infile), make_tflite_compatible)
+    model = onnx2keras(onnx.load(infile, load_external_data=False), make_tflite_compatible, os.path.dirname(infile))
     if export_saved_model:
         import tensorflow.compat.v1 as tf_v1
         tf_v1.keras.experimental.export_saved_model(model, export_saved_model)
@@ -1,18 +1,20 @@
 import warnings
 from io import BytesIO
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 import onnx
+from onnx import helper, numpy_helper
 import torch.nn
 from torch.nn import Module
 import torch.nn.functional as F
 from torchvision import models
 from numpy.testing import assert_almost_equal
 import numpy as np
+import pytest
 import tensorflow as tf
 
 from onnx2keras import onnx2keras, compatible_data_format, OnnxConstant, OnnxTensor, InterleavedImageBatch, \
-    ensure_data_format, OptimizationMissingWarning
+    ensure_data_format, OptimizationMissingWarning, TfKerasOperations, Constant, layout_plan, load_initializer
 
 
 def make_onnx_model(net, indata, opset_version=None):
@@ -49,6 +51,24 @@ def _convert_and_compare_output(net, indata, precition=5, image_out=True, savabl
     assert_almost_equal(y1, y2, precition)
     return kernas_net
 
+def make_mixed_layout_graph():
+    # conv(conv(x) + reshape(x)), where the reshape output is an OnnxTensor and the conv output is not
+    w = numpy_helper.from_array(np.random.rand(3, 3, 1, 1).astype(np.float32), 'w')
+    shape = numpy_helper.from_array(np.array([1, 3, 8, 8], dtype=np.int64), 'shape')
+    nodes = [
+        helper.make_node('Conv', ['x', 'w'], ['a'], kernel_shape=[1, 1], pads=[0, 0, 0, 0], strides=[1, 1],
+                         dilations=[1, 1], group=1),
+        helper.make_node('Reshape', ['x', 'shape'], ['b']),
+        helper.make_node('Add', ['a', 'b'], ['s']),
+        helper.make_node('Conv', ['s', 'w'], ['y'], kernel_shape=[1, 1], pads=[0, 0, 0, 0], strides=[1, 1],
+                         dilations=[1, 1], group=1),
+    ]
+    return helper.make_graph(nodes, 'mixed_layout',
+                             [helper.make_tensor_value_info('x', onnx.TensorProto.FLOAT, [1, 3, 8, 8])],
+                             [helper.make_tensor_value_info('y', onnx.TensorProto.FLOAT, [1, 3, 8, 8])],
+                             [w, shape])
+
+
 class GlobalAvgPool(Module):
     def forward(self, x):
         return x.mean([2, 3])
@@ -66,6 +86,147 @@ class TestUtils:
         assert not compatible_data_format(InterleavedImageBatch, OnnxTensor)
         assert not compatible_data_format(InterleavedImageBatch, OnnxConstant)
 
+    def test_ensure_data_format_reuses_conversion(self):
+        x = TfKerasOperations().make_constant(np.random.rand(1, 3, 4, 5))
+        y = ensure_data_format(x, InterleavedImageBatch)
+        assert y.shape == (1, 4, 5, 3)
+        assert y.flags['C_CONTIGUOUS']
+        assert ensure_data_format(x, InterleavedImageBatch) is y
+        assert ensure_data_format(y, OnnxTensor) is x
+
+    def test_constant_folding(self):
+        ops = TfKerasOperations()
+        shape, = ops.op_shape(ops.make_input([1, 3, 16, 32], np.float32))
+        h, = ops.op_gather(shape, ops.make_constant(2))
+        h, = ops.op_cast(h, 1)
+        assert h.dtype == np.float32
+        h, = ops.op_mul(h, ops.make_constant(2.0))
+        h, = ops.op_add(h, ops.make_constant(1.0))
+        h, = ops.op_sub(h, ops.make_constant(3.0))
+        assert isinstance(h, Constant)
+        assert h == 30.0
+
+    def test_make_op(self):
+        ops = TfKerasOperations()
+        out, = ops.make_op('Relu', [ops.make_input([1, 3, 4, 4], np.float32)], {})
+        assert out.data_format is InterleavedImageBatch
+        with pytest.raises(NotImplementedError, match='NonMaxSuppression'):
+            ops.make_op('NonMaxSuppression', [], {})
+
+    def test_transpose_constant(self):
+        ops = TfKerasOperations()
+        x = ops.make_constant(np.random.rand(2, 3, 4))
+        y, = ops.op_transpose(x, [2, 0, 1])
+        assert isinstance(y, Constant)
+        assert_almost_equal(y, x.transpose(2, 0, 1))
+
+    def test_softmax_before_opset13(self):
+        ops = TfKerasOperations()
+        ops.opset = 11
+        # Softmax over the flattened C, H and W axes
+        with pytest.raises(NotImplementedError):
+            ops.op_softmax(ops.make_input([1, 3, 8, 8], np.float32), 1)
+        out, = ops.op_softmax(ops.make_input([1, 3, 1, 1], np.float32), 1)
+        assert out.shape == (1, 1, 1, 3)
+
+    def test_external_data(self):
+        graph = make_mixed_layout_graph()
+        with TemporaryDirectory() as base_dir:
+            onnx.save_model(helper.make_model(graph), base_dir + '/model.onnx', save_as_external_data=True,
+                            location='weights', size_threshold=0)
+            onnx_model = onnx.load(base_dir + '/model.onnx', load_external_data=False)
+            for init, expected in zip(onnx_model.graph.initializer, graph.initializer):
+                weights = load_initializer(init, base_dir)
+                assert isinstance(weights, np.memmap)
+                assert_almost_equal(weights, numpy_helper.to_array(expected))
+            keras_net = onnx2keras(onnx_model, base_dir=base_dir)
+        assert [l.__class__.__name__ for l in keras_net.layers].count('Conv2D') == 2
+
+    def test_layout_plan(self):
+        graph = make_mixed_layout_graph()
+        plan = layout_plan(graph)
+        assert plan['a'] is InterleavedImageBatch
+        assert plan['s'] is InterleavedImageBatch
+        assert plan['b'] is InterleavedImageBatch
+
+    def test_layout_plan_fan_out(self):
+        # relu(producer(x)) consumed by one conv and one reshape, with the consumers in either order
+        w = numpy_helper.from_array(np.random.rand(3, 3, 1, 1).astype(np.float32), 'w')
+        shape = numpy_helper.from_array(np.array([1, 3, 8, 8], dtype=np.int64), 'shape')
+        conv = helper.make_node('Conv', ['r', 'w'], ['c'], kernel_shape=[1, 1], pads=[0, 0, 0, 0], strides=[1, 1],
+                                dilations=[1, 1], group=1)
+        reshape = helper.make_node('Reshape', ['r', 'shape'], ['b'])
+        producers = {InterleavedImageBatch: helper.make_node('Conv', ['x', 'w'], ['p'], kernel_shape=[1, 1],
+                                                             pads=[0, 0, 0, 0], strides=[1, 1], dilations=[1, 1],
+                                                             group=1),
+                     OnnxTensor: helper.make_node('Reshape', ['x', 'shape'], ['p'])}
+        for format, producer in producers.items():
+            for consumers in ([conv, reshape], [reshape, conv]):
+                nodes = [producer, helper.make_node('Relu', ['p'], ['r'])] + consumers
+                graph = helper.make_graph(nodes, 'fan_out',
+                                          [helper.make_tensor_value_info('x', onnx.TensorProto.FLOAT, [1, 3, 8, 8])],
+                                          [helper.make_tensor_value_info('c', onnx.TensorProto.FLOAT, [1, 3, 8, 8]),
+                                           helper.make_tensor_value_info('b', onnx.TensorProto.FLOAT, [1, 3, 8, 8])],
+                                          [w, shape])
+                assert layout_plan(graph)['r'] is format
+
+    def test_mixed_layout_add(self):
+        model = helper.make_model(make_mixed_layout_graph())
+        with warnings.catch_warnings(record=True) as warns:
+            warnings.simplefilter("always")
+            keras_net = onnx2keras(model)
+        # x needs to be transposed for the reshape and b for the add, but nothing more
+        assert len([w for w in warns if w.category is OptimizationMissingWarning]) == 2
+        x = np.random.rand(1, 3, 8, 8).astype(np.float32)
+        w = numpy_helper.to_array(model.graph.initializer[0])[:, :, 0, 0]
+        a = np.einsum('oc,nchw->nohw', w, x)
+        expected = np.einsum('oc,nchw->nohw', w, a + x)
+        y = keras_net.predict(x.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+        assert_almost_equal(y, expected, 5)
+
+    def test_fold_batchnorm(self):
+        # Exported torch models have their batchnorms folded already
+        w, b, scale, offset, mean, var = [np.random.rand(*shape).astype(np.float32)
+                                          for shape in [(4, 3, 1, 1), (4,), (4,), (4,), (4,), (4,)]]
+        for conv_inputs, conv_bias in [(['x', 'w'], 0), (['x', 'w', 'b'], b)]:
+            nodes = [
+                helper.make_node('Conv', conv_inputs, ['c'], kernel_shape=[1, 1], pads=[0, 0, 0, 0], strides=[1, 1],
+                                 dilations=[1, 1], group=1),
+                helper.make_node('BatchNormalization', ['c', 'scale', 'offset', 'mean', 'var'], ['y'],
+                                 epsilon=1e-5, momentum=0.9),
+            ]
+            graph = helper.make_graph(nodes, 'conv_bn',
+                                      [helper.make_tensor_value_info('x', onnx.TensorProto.FLOAT, [1, 3, 8, 8])],
+                                      [helper.make_tensor_value_info('y', onnx.TensorProto.FLOAT, [1, 4, 8, 8])],
+                                      [numpy_helper.from_array(a, n) for a, n in zip(
+                                          [w, b, scale, offset, mean, var], ['w', 'b', 'scale', 'offset', 'mean', 'var'])])
+            keras_net = onnx2keras(helper.make_model(graph))
+            assert [l.__class__.__name__ for l in keras_net.layers] == ['InputLayer', 'Conv2D']
+            x = np.random.rand(1, 3, 8, 8).astype(np.float32)
+            c = np.einsum('oc,nchw->nohw', w[:, :, 0, 0], x) + np.reshape(conv_bias, (-1, 1, 1))
+            expected = (c - mean[:, None, None]) / np.sqrt(var[:, None, None] + 1e-5) * scale[:, None, None] + offset[:, None, None]
+            y = keras_net.predict(x.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+            assert_almost_equal(y, expected, 5)
+
+    def test_conv_weights_not_kept(self):
+        w, b = np.random.rand(4, 3, 1, 1).astype(np.float32), np.random.rand(4).astype(np.float32)
+        nodes = [
+            helper.make_node('Conv', ['x', 'w', 'b'], ['c'], kernel_shape=[1, 1], pads=[0, 0, 0, 0], strides=[1, 1],
+                             dilations=[1, 1], group=1),
+            helper.make_node('Relu', ['c'], ['y']),
+        ]
+        graph = helper.make_graph(nodes, 'conv_relu',
+                                  [helper.make_tensor_value_info('x', onnx.TensorProto.FLOAT, [1, 3, 8, 8])],
+                                  [helper.make_tensor_value_info('y', onnx.TensorProto.FLOAT, [1, 4, 8, 8])],
+                                  [numpy_helper.from_array(w, 'w'), numpy_helper.from_array(b, 'b')])
+        keras_net = onnx2keras(helper.make_model(graph))
+        # The onnx weights are not referenced by the model once keras has its own copy
+        assert all(getattr(l.output, 'foldable_conv', None) is None for l in keras_net.layers)
+        x = np.random.rand(1, 3, 8, 8).astype(np.float32)
+        expected = np.maximum(np.einsum('oc,nchw->nohw', w[:, :, 0, 0], x) + b[:, None, None], 0)
+        y = keras_net.predict(x.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+        assert_almost_equal(y, expected, 5)
+
 
 class TestOnnx:
     def test_conv(self):
@@ -96,6 +257,11 @@ class TestOnnx:
         x = np.random.rand(1, 3, 224, 224).astype(np.float32)
         convert_and_compare_output(net, x, 5)
 
+    def test_softmax_channels(self):
+        net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 3), torch.nn.Softmax(dim=1))
+        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
+        convert_and_compare_output(net, x, opset_version=13)
+
     def test_maxpool(self):
         net = torch.nn.Sequential(torch.nn.MaxPool2d(2))
         x = np.random.rand(1, 3, 224, 224).astype(np.float32)
@@ -114,6 +280,15 @@ class TestOnnx:
             x = np.random.rand(1, 3, 224, 224).astype(np.float32)
             convert_and_compare_output(Dbl(), x)
 
+    def test_concat_slices(self):
+        class Split(Module):
+            def forward(self, x):
+                return torch.cat((x[:, :1], x[:, 1:]), 1)
+        net = torch.nn.Sequential(Split(), torch.nn.ReLU())
+        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
+        kernas_net = convert_and_compare_output(net, x, opset_version=11)
+        assert [l.__class__.__name__ for l in kernas_net.layers] == ['InputLayer', 'ReLU']
+
     def test_conv_transpose(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(3, 16, 5, 2), torch.nn.ReLU())
         x = np.random.rand(1, 3, 112, 112).astype(np.float32)
@@ -129,6 +304,13 @@ class TestOnnx:
         x = np.random.rand(1, 3, 384, 544).astype(np.float32)
         convert_and_compare_output(net, x)
 
+    def test_conv_shared_padding(self):
+        net = torch.nn.Sequential(torch.nn.Conv2d(3, 8, kernel_size=3, padding=(1, 2)),
+                                  torch.nn.Conv2d(8, 8, kernel_size=3, padding=(1, 2)))
+        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
+        keras_net = convert_and_compare_output(net, x)
+        assert [l.__class__.__name__ for l in keras_net.layers] == ['InputLayer', 'ZeroPadding2D', 'Conv2D', 'Conv2D']
+
     def test_conv_transpose_no_bias(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(3, 16, 5, 2, bias=False), torch.nn.ReLU())
         x = np.random.rand(1, 3, 112, 112).astype(np.float32)
@@ -144,6 +326,11 @@ class TestOnnx:
         x = np.random.rand(1, 16, 112, 112).astype(np.float32)
         convert_and_compare_output(net, x)
 
+    def test_conv_transpose_grouped_more_outputs(self):
+        net = torch.nn.Sequential(torch.nn.ConvTranspose2d(8, 16, 5, 2, groups=2), torch.nn.ReLU())
+        x = np.random.rand(1, 8, 112, 112).astype(np.float32)
+        convert_and_compare_output(net, x)
+
     def test_conv_transpose_grouped_fully(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(16, 16, 5, 2, groups=16), torch.nn.ReLU())
         x = np.random.rand(1, 16, 112, 112).astype(np.float32)
@@ -225,6 +412,17 @@ class TestOnnx:
         x = np.random.rand(1, 8, 224, 224).astype(np.float32)
         convert_and_compare_output(net, x, missing_optimizations=True, make_tflite_compatible=True)
 
+    def test_groupwise_tflite_compat_block_diagonal(self):
+        net = torch.nn.Conv2d(6, 12, 4, groups=3)
+        x = np.random.rand(1, 6, 224, 224).astype(np.float32)
+        kernas_net = convert_and_compare_output(net, x, make_tflite_compatible=True)
+        assert [l.__class__.__name__ for l in kernas_net.layers] == ['InputLayer', 'Conv2D']
+
+    def test_groupwise_tflite_compat_many_groups(self):
+        net = torch.nn.Conv2d(16, 16, 3, groups=8)
+        x = np.random.rand(1, 16, 64, 64).astype(np.float32)
+        convert_and_compare_output(net, x, missing_optimizations=True, make_tflite_compatible=True)
+
     def test_groupwise_no_bias(self):
         net = torch.nn.Conv2d(6, 12, 4, groups=3, bias=False)
         x = np.random.rand(1, 6, 224, 224).astype(np.float32)
@@ -300,6 +498,14 @@ class TestOnnx:
         x = np.random.rand(1, 3, 224, 224).astype(np.float32)
         convert_and_compare_output(net, x)
 
+    def test_global_avg_pool_keepdims(self):
+        class AvgTst(Module):
+            def forward(self, x):
+                return x.mean([2, 3], keepdim=True)
+        net = torch.nn.Sequential(AvgTst(), torch.nn.Conv2d(3, 8, 1), torch.nn.ReLU())
+        x = np.random.rand(1, 3, 16, 16).astype(np.float32)
+        convert_and_compare_output(net, x)
+
     def test_flatten(self):
         class Tst(Module):
             def forward(self, x):
@@ -409,6 +615,21 @@ class TestOnnx:
         x = np.random.rand(1, 1, 16, 16).astype(np.float32)
         convert_and_compare_output(net, x, image_out=False)
 
+    def test_matmul_batched(self):
+        class Net(Module):
+            def forward(self, x):
+                x = x.reshape(1, 3, 16, 16)
+                return torch.matmul(x, x)
+        net = torch.nn.Sequential(Net(), torch.nn.ReLU())
+        x = np.random.rand(1, 3, 16, 16).astype(np.float32)
+        keras_net = convert_and_compare_output(net, x, image_out=False)
+        with NamedTemporaryFile(suffix='.h5') as f:
+            f.close()
+            keras_net.save(f.name)
+            loaded_net = tf.keras.models.load_model(f.name)
+        keras_x = x.transpose(0, 2, 3, 1)
+        assert_almost_equal(loaded_net.predict(keras_x), keras_net.predict(keras_x), 5)
+
     def test_unsupported_optimasation(self):
         class Reshape(Module):
             def forward(self, x):